@@ -9,10 +9,13 @@ Lead Magnet Bot - бот для раздачи лид-магнитов чере
 """
 
 import logging
+import os
+import re
 import time
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
 from telegram.ext import (
     Application,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes
 )
@@ -20,16 +23,17 @@ from telegram.constants import ParseMode
 
 from config import Config
 from database.database import init_db, close_db, get_session
-from database import ChannelButton, ChannelButtonClick
 from modules.payments.subscription import (
-    get_or_create_user,
     check_channel_subscription,
-    get_subscription_channel
+    get_subscription_channel,
+    on_chat_member_update
 )
 from modules.payments.messages import get_free_access_message
 from modules.payments.keyboards import get_free_access_keyboard
 from modules.payments.handlers import register_subscription_handlers
 from modules.payments.admin_handlers import register_admin_handlers
+from modules.cache.button_cache import get_button_by_message_id, get_cached as get_cached_button
+from modules.clicks.batcher import enqueue_click, start_click_batcher, stop_click_batcher
 
 # Настройка логирования
 logging.basicConfig(
@@ -38,6 +42,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Deep link параметр кнопки канала: channel_button_<message_id>
+_CHANNEL_BUTTON_RE = re.compile(r"^channel_button_(\d+)$")
+
+# Статичные клавиатуры и тексты - собираем один раз при импорте,
+# а не на каждый /start
+_EMPTY_KB = InlineKeyboardMarkup([])
+
+# Статичные сообщения отправляются без parse_mode: жирный заголовок задан
+# готовым списком MessageEntity (offsets - в UTF-16 code units), парсинг
+# разметки на каждый /start не нужен
+_MSG_CONFIRMED_EXTERNAL = (
+    "✅ ПОДПИСКА ПОДТВЕРЖДЕНА!\n\n"
+    "Ваша ссылка готова! Нажмите на кнопку ниже, чтобы получить доступ."
+)
+
+_MSG_CONFIRMED_BOT = (
+    "✅ ПОДПИСКА ПОДТВЕРЖДЕНА!\n\n"
+    "Доступ к боту предоставлен!"
+)
+
+_ENT_CONFIRMED = [MessageEntity(
+    type=MessageEntity.BOLD,
+    offset=len("✅ ".encode('utf-16-le')) // 2,
+    length=len("ПОДПИСКА ПОДТВЕРЖДЕНА!".encode('utf-16-le')) // 2
+)]
+
+_MSG_WELCOME = (
+    "👋 Добро пожаловать!\n\n"
+    "Этот бот раздает лид-магниты через кнопки в канале.\n\n"
+    "Перейдите по кнопке в канале, чтобы получить доступ к материалам."
+)
+
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start - проверяет подписку и выдает ссылку."""
@@ -48,150 +84,122 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     start_param = None
     if context.args and len(context.args) > 0:
         start_param = context.args[0]
-        logger.info(f"🚀 Команда /start вызвана пользователем {telegram_id} с параметром: {start_param}")
+        logger.info("🚀 Команда /start вызвана пользователем %s с параметром: %s", telegram_id, start_param)
         
         # Если параметр начинается с "channel_" - это нажатие на кнопку в канале
         if start_param.startswith("channel_"):
             try:
-                async with get_session() as session:
-                    # Получаем или создаем пользователя
-                    user = await get_or_create_user(
-                        telegram_id,
-                        session,
-                        username=update.effective_user.username,
-                        first_name=update.effective_user.first_name
-                    )
-                    
-                    # Пытаемся найти button_id из параметра (формат: channel_button_123)
-                    button_id = None
-                    post_id = None
-                    button_link = None
-                    button_lead_magnet_type = None
-                    if start_param.startswith("channel_button_"):
-                        try:
-                            post_id = int(start_param.replace("channel_button_", ""))
-                            # Ищем кнопку по message_id
-                            from sqlalchemy import select
-                            button_result = await session.execute(
-                                select(ChannelButton).where(ChannelButton.message_id == post_id)
-                            )
-                            found_button = button_result.scalar_one_or_none()
-                            if found_button:
-                                button_id = found_button.id
-                                button_link = found_button.link
-                                button_lead_magnet_type = found_button.lead_magnet_type
-                                # Сохраняем информацию о кнопке в context для последующей выдачи ссылки
-                                context.user_data['channel_button_id'] = button_id
-                                context.user_data['channel_button_link'] = button_link
-                                context.user_data['channel_button_type'] = button_lead_magnet_type
-                                logger.info(f"✅ Сохранена информация о кнопке: button_id={button_id}, link={button_link}, type={button_lead_magnet_type}")
-                        except (ValueError, Exception) as e:
-                            logger.debug(f"Could not extract button_id from param: {e}")
-                    
-                    # Сохраняем нажатие на кнопку
-                    click = ChannelButtonClick(
-                        user_id=user.id,
-                        telegram_id=telegram_id,
-                        button_id=button_id,
-                        source=start_param,
-                        post_id=post_id if 'post_id' in locals() else None
-                    )
-                    session.add(click)
-                    await session.commit()
-                    logger.info(f"✅ Зафиксировано нажатие на кнопку канала: {start_param} от пользователя {telegram_id}, button_id: {button_id}")
-                    
-                    # ВАЖНО: Сразу обрабатываем кнопку канала и выходим
-                    if button_link:
-                        # Получаем канал для проверки
-                        channel_username = await get_subscription_channel()
-                        
-                        # Проверяем подписку сразу
-                        try:
-                            is_subscribed = await check_channel_subscription(context.bot, telegram_id, channel_username)
-                            logger.info(f"🔵 User {telegram_id} subscription status: {is_subscribed}")
-                            
-                            if is_subscribed:
-                                # Пользователь подписан - сразу выдаем ссылку
-                                if button_lead_magnet_type == "external":
-                                    # Внешняя ссылка - показываем кнопку со ссылкой
-                                    keyboard = InlineKeyboardMarkup([
-                                        [InlineKeyboardButton("🔗 Получить доступ", url=button_link)]
-                                    ])
-                                    message = """
-✅ **ПОДПИСКА ПОДТВЕРЖДЕНА!**
+                # Пытаемся найти button_id из параметра (формат: channel_button_123)
+                button_id = None
+                post_id = None
+                button_link = None
+                button_lead_magnet_type = None
+                button_match = _CHANNEL_BUTTON_RE.match(start_param)
+                if button_match:
+                    post_id = int(button_match.group(1))
+                    # Сначала чистый in-memory lookup; в БД идем только при промахе кэша
+                    cached_button = get_cached_button(post_id)
+                    if cached_button is None:
+                        async with get_session() as session:
+                            cached_button = await get_button_by_message_id(session, post_id)
+                    if cached_button:
+                        button_id, button_link, button_lead_magnet_type = cached_button
+                        # Сохраняем информацию о кнопке в context для последующей
+                        # выдачи ссылки - одним ключом, чтобы чистить атомарно
+                        context.user_data['channel_button'] = {
+                            'id': button_id,
+                            'link': button_link,
+                            'type': button_lead_magnet_type,
+                        }
+                        logger.info("✅ Сохранена информация о кнопке: button_id=%s, link=%s, type=%s", button_id, button_link, button_lead_magnet_type)
 
-Ваша ссылка готова! Нажмите на кнопку ниже, чтобы получить доступ.
-"""
-                                else:
-                                    # Доступ к боту - просто подтверждаем
-                                    keyboard = InlineKeyboardMarkup([])
-                                    message = """
-✅ **ПОДПИСКА ПОДТВЕРЖДЕНА!**
+                # Ставим нажатие в очередь - фоновый батчер сам сделает upsert
+                # пользователя и запись нажатия, хот-пасу БД не нужна
+                await enqueue_click(
+                    telegram_id=telegram_id,
+                    username=update.effective_user.username,
+                    first_name=update.effective_user.first_name,
+                    button_id=button_id,
+                    source=start_param,
+                    post_id=post_id
+                )
+                logger.info("✅ Зафиксировано нажатие на кнопку канала: %s от пользователя %s, button_id: %s", start_param, telegram_id, button_id)
 
-Доступ к боту предоставлен!
-"""
-                                
-                                await update.message.reply_text(
-                                    message,
-                                    reply_markup=keyboard,
-                                    parse_mode=ParseMode.MARKDOWN
-                                )
-                                # Очищаем данные о кнопке после выдачи ссылки
-                                context.user_data.pop('channel_button_link', None)
-                                context.user_data.pop('channel_button_type', None)
-                                context.user_data.pop('channel_button_id', None)
-                                logger.info(f"✅ Link issued immediately to subscribed user {telegram_id}: {button_link}, type: {button_lead_magnet_type}")
-                                elapsed = int((time.perf_counter() - t0) * 1000)
-                                logger.info(f"⏱ /start handled in {elapsed} ms (channel button - subscribed)")
-                                return
+                # Дальше только Telegram API - соединение с БД не занято
+                # ВАЖНО: Сразу обрабатываем кнопку канала и выходим
+                if button_link:
+                    # Получаем канал для проверки
+                    channel_username = await get_subscription_channel()
+                    
+                    # Проверяем подписку сразу
+                    try:
+                        is_subscribed = await check_channel_subscription(context.bot, telegram_id, channel_username)
+                        logger.info("🔵 User %s subscription status: %s", telegram_id, is_subscribed)
+                        
+                        if is_subscribed:
+                            # Пользователь подписан - сразу выдаем ссылку
+                            if button_lead_magnet_type == "external":
+                                # Внешняя ссылка - показываем кнопку со ссылкой
+                                keyboard = InlineKeyboardMarkup([
+                                    [InlineKeyboardButton("🔗 Получить доступ", url=button_link)]
+                                ])
+                                message = _MSG_CONFIRMED_EXTERNAL
                             else:
-                                # Пользователь не подписан - показываем диалог проверки подписки
-                                await update.message.reply_text(
-                                    get_free_access_message(channel_username),
-                                    reply_markup=get_free_access_keyboard(channel_username),
-                                    parse_mode=ParseMode.MARKDOWN
-                                )
-                                logger.info(f"🔵 User came via channel button but not subscribed, showing subscription check. Link: {button_link}, Type: {button_lead_magnet_type}")
-                                elapsed = int((time.perf_counter() - t0) * 1000)
-                                logger.info(f"⏱ /start handled in {elapsed} ms (channel button - not subscribed)")
-                                return
-                        except Exception as e:
-                            logger.error(f"❌ Error checking subscription for channel button: {e}")
-                            import traceback
-                            logger.error(f"Traceback: {traceback.format_exc()}")
-                            # В случае ошибки показываем диалог проверки подписки
-                            channel_username = await get_subscription_channel()
+                                # Доступ к боту - просто подтверждаем
+                                keyboard = _EMPTY_KB
+                                message = _MSG_CONFIRMED_BOT
+                            
+                            await update.message.reply_text(
+                                message,
+                                reply_markup=keyboard,
+                                entities=_ENT_CONFIRMED
+                            )
+                            # Очищаем данные о кнопке после выдачи ссылки
+                            context.user_data.pop('channel_button', None)
+                            logger.info("✅ Link issued immediately to subscribed user %s: %s, type: %s", telegram_id, button_link, button_lead_magnet_type)
+                            elapsed = int((time.perf_counter() - t0) * 1000)
+                            logger.info("⏱ /start handled in %s ms (channel button - subscribed)", elapsed)
+                            return
+                        else:
+                            # Пользователь не подписан - показываем диалог проверки подписки
                             await update.message.reply_text(
                                 get_free_access_message(channel_username),
                                 reply_markup=get_free_access_keyboard(channel_username),
                                 parse_mode=ParseMode.MARKDOWN
                             )
+                            logger.info("🔵 User came via channel button but not subscribed, showing subscription check. Link: %s, Type: %s", button_link, button_lead_magnet_type)
                             elapsed = int((time.perf_counter() - t0) * 1000)
-                            logger.info(f"⏱ /start handled in {elapsed} ms (channel button - error)")
+                            logger.info("⏱ /start handled in %s ms (channel button - not subscribed)", elapsed)
                             return
-            except Exception as e:
-                logger.error(f"❌ Ошибка при сохранении нажатия на кнопку: {e}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
+                    except Exception:
+                        logger.exception("❌ Error checking subscription for channel button")
+                        # В случае ошибки показываем диалог проверки подписки
+                        channel_username = await get_subscription_channel()
+                        await update.message.reply_text(
+                            get_free_access_message(channel_username),
+                            reply_markup=get_free_access_keyboard(channel_username),
+                            parse_mode=ParseMode.MARKDOWN
+                        )
+                        elapsed = int((time.perf_counter() - t0) * 1000)
+                        logger.info("⏱ /start handled in %s ms (channel button - error)", elapsed)
+                        return
+            except Exception:
+                logger.exception("❌ Ошибка при сохранении нажатия на кнопку")
     else:
-        logger.info(f"🚀 Команда /start вызвана пользователем {telegram_id}")
+        logger.info("🚀 Команда /start вызвана пользователем %s", telegram_id)
     
-    # Обычный /start без параметров - просто приветствие
-    await update.message.reply_text(
-        "👋 Добро пожаловать!\n\n"
-        "Этот бот раздает лид-магниты через кнопки в канале.\n\n"
-        "Перейдите по кнопке в канале, чтобы получить доступ к материалам.",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    # Обычный /start без параметров - просто приветствие (обычный текст,
+    # разметки нет - parse_mode не нужен)
+    await update.message.reply_text(_MSG_WELCOME)
     
     elapsed = int((time.perf_counter() - t0) * 1000)
-    logger.info(f"⏱ /start handled in {elapsed} ms")
+    logger.info("⏱ /start handled in %s ms", elapsed)
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок для предотвращения падения бота."""
     error = context.error
-    logger.error(f"Exception while handling an update: {error}", exc_info=error)
+    logger.error("Exception while handling an update: %s", error, exc_info=error)
 
 
 async def post_init(application: Application) -> None:
@@ -200,13 +208,19 @@ async def post_init(application: Application) -> None:
     try:
         await init_db()
         logger.info("✅ Database initialized")
+        # Запускаем фоновый батчер нажатий (работает на том же event loop)
+        start_click_batcher()
     except Exception as e:
-        logger.critical(f"Failed to initialize database: {e}")
-        import traceback
-        logger.critical(f"Traceback: {traceback.format_exc()}")
+        logger.critical("Failed to initialize database: %s", e, exc_info=True)
         raise
 
 
+async def post_shutdown(application: Application) -> None:
+    """Корректное завершение: останавливаем батчер и закрываем пул БД."""
+    await stop_click_batcher()
+    await close_db()
+
+
 def main():
     """Главная функция приложения."""
     logger.info("=" * 80)
@@ -217,7 +231,7 @@ def main():
     try:
         Config.validate()
     except ValueError as e:
-        logger.critical(f"Configuration error: {e}")
+        logger.critical("Configuration error: %s", e)
         return
     
     # Создание приложения с post_init callback для инициализации БД
@@ -226,6 +240,16 @@ def main():
         Application.builder()
         .token(Config.BOT_TOKEN)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(int(os.getenv('CONCURRENT_UPDATES', '256')))
+        # Пул HTTP-соединений к Telegram: дефолтный размер мал и при
+        # concurrent_updates обработчики начинают ждать checkout соединения
+        .connection_pool_size(256)
+        .pool_timeout(10)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .get_updates_connection_pool_size(64)
+        .get_updates_pool_timeout(10)
         .build()
     )
     
@@ -233,11 +257,18 @@ def main():
     logger.info("🔄 Registering handlers...")
     
     # Команда /start
-    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("start", start_command, block=False))
     logger.info("✅ Handler /start registered")
     
     # Обработчики подписки
     register_subscription_handlers(application)
+
+    # Push-апдейты вступлений/выходов канала - держат множество подписчиков
+    # в памяти, чтобы проверка подписки не ходила в Telegram API
+    application.add_handler(
+        ChatMemberHandler(on_chat_member_update, ChatMemberHandler.CHAT_MEMBER, block=False)
+    )
+    logger.info("✅ Chat member handler registered")
     
     # Админ-панель
     register_admin_handlers(application)
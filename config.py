@@ -3,7 +3,7 @@
 """
 
 import os
-from typing import List
+from typing import FrozenSet
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
@@ -17,13 +17,11 @@ class Config:
     BOT_TOKEN: str = os.getenv('BOT_TOKEN', '')
     
     # Список админов (идентификаторы Telegram), через запятую в .env: ADMIN_USER_IDS=123,456
+    # frozenset: O(1) проверка "пользователь - админ?" на каждом админ-апдейте
     _ADMIN_IDS_RAW: str = os.getenv('ADMIN_USER_IDS', '')
-    ADMIN_USER_IDS: List[int] = []
-    if _ADMIN_IDS_RAW:
-        try:
-            ADMIN_USER_IDS = [int(x.strip()) for x in _ADMIN_IDS_RAW.split(',') if x.strip().isdigit()]
-        except Exception:
-            ADMIN_USER_IDS = []
+    ADMIN_USER_IDS: FrozenSet[int] = frozenset(
+        int(x.strip()) for x in _ADMIN_IDS_RAW.split(',') if x.strip().isdigit()
+    )
 
     # Канал для проверки подписки
     CHANNEL_USERNAME: str = os.getenv('CHANNEL_USERNAME', '@TaktikaKutuzova')
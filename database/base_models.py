@@ -5,7 +5,7 @@ Simplified User model only.
 
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Integer, BigInteger, String, DateTime
+from sqlalchemy import Integer, BigInteger, String, DateTime, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -26,9 +26,9 @@ class User(Base):
     first_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     last_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
 
-    # Registration and activity
-    registration_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    last_activity: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Registration and activity (таймстемпы проставляет БД через now())
+    registration_date: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    last_activity: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
 
     def __repr__(self) -> str:
         return f"<User(telegram_id={self.telegram_id}, username={self.username})>"
@@ -12,6 +12,7 @@ import os
 import re
 from typing import AsyncGenerator
 from contextlib import asynccontextmanager
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
     async_sessionmaker,
@@ -75,8 +76,11 @@ if DATABASE_URL.startswith('postgresql+asyncpg://'):
         logger.info("Removed sslmode parameter from DATABASE_URL (asyncpg doesn't support it)")
 
 # Pool configuration
-DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
-DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '0'))
+# Бот I/O-bound: 20+20 соединений дешевы для Postgres, а дефолтные 5/0
+# означали, что шестой одновременный запрос ждет checkout до 30 секунд.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
 
 # Determine if we need SSL (for PostgreSQL)
 is_postgres = DATABASE_URL.startswith('postgresql+asyncpg://')
@@ -84,31 +88,22 @@ connect_args = {}
 
 if is_postgres:
     import ssl
-    import asyncpg
-    
+
     # Create SSL context that doesn't verify certificates (Railway uses self-signed certs)
     ssl_context = ssl.create_default_context()
     ssl_context.check_hostname = False
     ssl_context.verify_mode = ssl.CERT_NONE
-    
+
     connect_args['ssl'] = ssl_context
-    
-    # Store original asyncpg.connect before patching
-    _original_asyncpg_connect = asyncpg.connect
-    
-    # Create wrapper that filters sslmode
-    async def _filtered_asyncpg_connect(*args, **kwargs):
-        """Wrapper around asyncpg.connect that filters out sslmode parameter."""
-        if 'sslmode' in kwargs:
-            logger.warning("Removing sslmode from connect args (asyncpg doesn't support it)")
-            del kwargs['sslmode']
-        if 'ssl' not in kwargs:
-            kwargs['ssl'] = ssl_context
-        return await _original_asyncpg_connect(*args, **kwargs)
-    
-    # Monkey-patch asyncpg.connect
-    asyncpg.connect = _filtered_asyncpg_connect
-    logger.info("Monkey-patched asyncpg.connect to filter sslmode parameter")
+
+    # Тюнинг asyncpg под короткие OLTP-запросы:
+    # - jit=off: JIT Postgres только добавляет время планирования тривиальным запросам
+    # - prepared_statement_cache_size: не перепарсивать одни и те же SELECT/INSERT
+    connect_args['server_settings'] = {
+        'jit': 'off',
+        'application_name': 'lead_magnet_bot',
+    }
+    connect_args['prepared_statement_cache_size'] = 256
 
 # Create async engine with controlled pool
 engine_kwargs = {
@@ -117,6 +112,7 @@ engine_kwargs = {
     'poolclass': QueuePool,
     'pool_size': DB_POOL_SIZE,
     'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
     'pool_pre_ping': True,
     'pool_recycle': 3600,
 }
@@ -125,6 +121,28 @@ if connect_args:
 
 engine = create_async_engine(DATABASE_URL, **engine_kwargs)
 
+if is_postgres:
+    # Убираем sslmode из параметров подключения только для этого engine
+    # (asyncpg его не поддерживает). Раньше здесь был глобальный
+    # monkey-patch asyncpg.connect - event затрагивает только наш пул.
+    @event.listens_for(engine.sync_engine, "do_connect")
+    def _strip_sslmode(dialect, conn_rec, cargs, cparams):
+        cparams.pop("sslmode", None)
+        cparams.setdefault("ssl", ssl_context)
+
+# Предупреждаем в логах, когда пул близок к исчерпанию
+_POOL_CAPACITY = DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _warn_pool_pressure(dbapi_conn, conn_record, conn_proxy):
+    checked_out = engine.pool.checkedout()
+    if checked_out >= 0.8 * _POOL_CAPACITY:
+        logger.warning(
+            "DB pool under pressure: %d/%d connections in use",
+            checked_out, _POOL_CAPACITY
+        )
+
 # Create async session factory
 async_session_maker = async_sessionmaker(
     engine,
@@ -152,11 +170,56 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
             raise
 
 
+# Идемпотентные DDL-апгрейды для существующих Postgres-баз. create_all
+# создает только отсутствующие таблицы и не трогает уже созданные, поэтому
+# изменения схемы (дефолты, индексы) надо досылать руками - Alembic в
+# проекте нет. Каждый стейтмент безопасен при повторном запуске.
+_PG_MIGRATIONS = [
+    # server_default=func.now() в моделях действует только на свежие таблицы;
+    # на базе, созданной до перехода с клиентского default=datetime.utcnow,
+    # колонки NOT NULL без дефолта - и любой INSERT без явного значения падал
+    "ALTER TABLE users ALTER COLUMN registration_date SET DEFAULT now()",
+    "ALTER TABLE users ALTER COLUMN last_activity SET DEFAULT now()",
+    "ALTER TABLE channel_buttons ALTER COLUMN created_at SET DEFAULT now()",
+    "ALTER TABLE channel_button_clicks ALTER COLUMN clicked_at SET DEFAULT now()",
+    "ALTER TABLE bot_settings ALTER COLUMN updated_at SET DEFAULT now()",
+    # Составные индексы аналитики кликов объявлены в metadata, но create_all
+    # не добавляет индексы к уже существующим таблицам
+    "CREATE INDEX IF NOT EXISTS ix_clicks_button_clicked"
+    " ON channel_button_clicks (button_id, clicked_at)",
+    "CREATE INDEX IF NOT EXISTS ix_clicks_tgid_clicked"
+    " ON channel_button_clicks (telegram_id, clicked_at)",
+    # Уникальный покрывающий индекс по message_id. До него дубликаты
+    # message_id были возможны - сперва переводим клики на оставляемую
+    # (минимальный id) кнопку и удаляем дубли, иначе CREATE UNIQUE упадет
+    "UPDATE channel_button_clicks c SET button_id = k.keep_id"
+    " FROM channel_buttons b"
+    " JOIN (SELECT message_id, min(id) AS keep_id FROM channel_buttons"
+    "       GROUP BY message_id HAVING count(*) > 1) k"
+    "   ON k.message_id = b.message_id"
+    " WHERE c.button_id = b.id AND b.id <> k.keep_id",
+    "DELETE FROM channel_buttons b"
+    " USING (SELECT message_id, min(id) AS keep_id FROM channel_buttons"
+    "        GROUP BY message_id HAVING count(*) > 1) k"
+    " WHERE b.message_id = k.message_id AND b.id <> k.keep_id",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_channel_buttons_message_id"
+    " ON channel_buttons (message_id) INCLUDE (link, lead_magnet_type)",
+    # BIGINT identity-PK в моделях касается только новых таблиц - старым
+    # расширяем тип колонок (повторный ALTER до того же типа - no-op)
+    # и поднимаем CACHE последовательностей под батчевые вставки
+    "ALTER TABLE channel_buttons ALTER COLUMN id TYPE bigint",
+    "ALTER TABLE channel_button_clicks ALTER COLUMN id TYPE bigint",
+    "ALTER TABLE channel_button_clicks ALTER COLUMN button_id TYPE bigint",
+    "ALTER SEQUENCE IF EXISTS channel_buttons_id_seq CACHE 100",
+    "ALTER SEQUENCE IF EXISTS channel_button_clicks_id_seq CACHE 100",
+]
+
+
 async def init_db() -> None:
     """
     Initialize database: create all tables.
     Should be called once at application startup.
-    
+
     IMPORTANT: All models must be imported before calling this function
     to ensure they are registered in Base.metadata.
     """
@@ -164,9 +227,12 @@ async def init_db() -> None:
     try:
         # Import all models to ensure they are registered in Base.metadata
         from . import models  # noqa: F401 - Import to register models
-        
+
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            if is_postgres:
+                for stmt in _PG_MIGRATIONS:
+                    await conn.execute(text(stmt))
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"ERROR in init_db(): {e}")
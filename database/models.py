@@ -6,13 +6,18 @@ Channel button tracking models.
 from datetime import datetime
 from typing import Optional, TYPE_CHECKING
 from sqlalchemy import (
-    Integer, BigInteger, String, ForeignKey, DateTime
+    Integer, BigInteger, String, ForeignKey, DateTime, Identity, Index, func
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 # Use Base from base_models to ensure all models are in the same metadata
 from .base_models import Base
 
+# BIGINT identity-PK для Postgres (кэшируемая последовательность - дешевые
+# батчевые вставки, нет потолка 2^31). На SQLite остается INTEGER, иначе
+# не работает автоинкремент rowid.
+_BigIntPK = BigInteger().with_variant(Integer, "sqlite")
+
 # Type checking only - avoid circular imports
 if TYPE_CHECKING:
     from .base_models import User
@@ -22,14 +27,26 @@ class ChannelButton(Base):
     """Information about created channel buttons."""
     __tablename__ = "channel_buttons"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # message_id уникален (на пост - одна кнопка); уникальный индекс позволяет
+    # планировщику остановиться после первого совпадения, а INCLUDE-колонки
+    # делают lookup /start чистым index-only scan на Postgres.
+    __table_args__ = (
+        Index(
+            "ix_channel_buttons_message_id",
+            "message_id",
+            unique=True,
+            postgresql_include=["link", "lead_magnet_type"],
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(_BigIntPK, Identity(always=False, cache=100), primary_key=True)
     channel_id: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
-    message_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    message_id: Mapped[int] = mapped_column(Integer, nullable=False)
     post_title: Mapped[str] = mapped_column(String(500), nullable=False)  # Название поста
     button_text: Mapped[str] = mapped_column(String(255), nullable=False)  # Название кнопки
     lead_magnet_type: Mapped[str] = mapped_column(String(50), nullable=False)  # "bot" or "external"
     link: Mapped[str] = mapped_column(String(500), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
     created_by: Mapped[int] = mapped_column(BigInteger, nullable=False)  # Telegram ID админа
 
     # Relationships
@@ -47,11 +64,19 @@ class ChannelButtonClick(Base):
     """Tracking clicks on channel button."""
     __tablename__ = "channel_button_clicks"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Составные индексы под аналитику: "нажатия по кнопке за период"
+    # и "нажатия пользователя за период". Префикс составного индекса
+    # покрывает и одиночные lookup'ы по button_id / telegram_id.
+    __table_args__ = (
+        Index("ix_clicks_button_clicked", "button_id", "clicked_at"),
+        Index("ix_clicks_tgid_clicked", "telegram_id", "clicked_at"),
+    )
+
+    id: Mapped[int] = mapped_column(_BigIntPK, Identity(always=False, cache=100), primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
-    telegram_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
-    button_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("channel_buttons.id"), nullable=True, index=True)
-    clicked_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    button_id: Mapped[Optional[int]] = mapped_column(_BigIntPK, ForeignKey("channel_buttons.id"), nullable=True)
+    clicked_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
     
     # Legacy fields (для обратной совместимости)
     post_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
@@ -72,7 +97,7 @@ class BotSettings(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     key: Mapped[str] = mapped_column(String(100), unique=True, nullable=False, index=True)
     value: Mapped[str] = mapped_column(String(500), nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
     updated_by: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)  # Telegram ID админа
 
     def __repr__(self) -> str:
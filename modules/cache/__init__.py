@@ -0,0 +1 @@
+"""In-memory caches for Lead Magnet Bot."""
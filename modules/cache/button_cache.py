@@ -0,0 +1,83 @@
+"""
+Button Cache - in-memory TTL кэш для кнопок канала.
+
+Убирает запрос к БД с горячего пути /start: при нажатии на кнопку в канале
+данные кнопки берутся из кэша, а не из Postgres. Кэш инвалидируется
+админ-обработчиками при создании/изменении кнопок.
+"""
+
+import logging
+import time
+from typing import Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import ChannelButton
+
+logger = logging.getLogger(__name__)
+
+# Время жизни записи в кэше (секунды)
+BUTTON_CACHE_TTL = 300
+
+# message_id -> (expires_at, (button_id, link, lead_magnet_type))
+_cache: dict = {}
+
+
+def get_cached(message_id: int) -> Optional[Tuple[int, str, str]]:
+    """
+    Чистый in-memory lookup без похода в БД.
+
+    Returns:
+        Кортеж (button_id, link, lead_magnet_type) или None при промахе/истекшем TTL
+    """
+    entry = _cache.get(message_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+async def get_button_by_message_id(
+    session: AsyncSession,
+    message_id: int
+) -> Optional[Tuple[int, str, str]]:
+    """
+    Получает данные кнопки по message_id поста в канале.
+
+    Сначала проверяет in-memory кэш; при промахе выполняет SELECT
+    и сохраняет результат на BUTTON_CACHE_TTL секунд.
+
+    Args:
+        session: Сессия БД
+        message_id: ID сообщения (поста) в канале
+
+    Returns:
+        Кортеж (button_id, link, lead_magnet_type) или None если кнопка не найдена
+    """
+    cached = get_cached(message_id)
+    if cached is not None:
+        return cached
+
+    # Забираем только нужные колонки - без материализации всей ORM-модели
+    # с длинными post_title/button_text
+    row = (await session.execute(
+        select(ChannelButton.id, ChannelButton.link, ChannelButton.lead_magnet_type)
+        .where(ChannelButton.message_id == message_id)
+        .limit(1)
+    )).first()
+    if row is None:
+        return None
+
+    data = (row.id, row.link, row.lead_magnet_type)
+    _cache[message_id] = (time.monotonic() + BUTTON_CACHE_TTL, data)
+    return data
+
+
+def invalidate(message_id: int) -> None:
+    """Удаляет кнопку из кэша (вызывается при создании/изменении кнопки)."""
+    _cache.pop(message_id, None)
+
+
+def invalidate_all() -> None:
+    """Полностью очищает кэш кнопок."""
+    _cache.clear()
@@ -0,0 +1 @@
+"""Click tracking modules for Lead Magnet Bot."""
@@ -0,0 +1,199 @@
+"""
+Click Batcher - батчинг записей о нажатиях на кнопки канала.
+
+Вместо отдельной транзакции (INSERT + COMMIT) на каждое нажатие, нажатия
+складываются в asyncio.Queue и записываются фоновой задачей одним
+multi-row INSERT каждые ~50 мс или при накоплении полного батча.
+При 1000 одновременных нажатий это десятки транзакций вместо тысячи.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import ChannelButtonClick, User
+from database.database import get_session
+
+logger = logging.getLogger(__name__)
+
+# Максимальное время ожидания перед записью батча (секунды)
+FLUSH_INTERVAL = 0.05
+# Максимальный размер батча
+MAX_BATCH_SIZE = 200
+
+# Очередь нажатий: каждый элемент - dict с полями ChannelButtonClick
+clicks_queue: asyncio.Queue = asyncio.Queue()
+
+_flush_task: Optional[asyncio.Task] = None
+
+
+async def enqueue_click(
+    telegram_id: int,
+    username: Optional[str] = None,
+    first_name: Optional[str] = None,
+    button_id: Optional[int] = None,
+    source: Optional[str] = None,
+    post_id: Optional[int] = None
+) -> None:
+    """
+    Ставит нажатие в очередь на запись.
+
+    Не открывает сессию БД - upsert пользователя и вставку нажатия
+    выполнит фоновая задача батчера.
+    """
+    await clicks_queue.put({
+        "telegram_id": telegram_id,
+        "username": username,
+        "first_name": first_name,
+        "button_id": button_id,
+        "source": source,
+        "post_id": post_id,
+    })
+
+
+def _build_cte_sql(row_count: int) -> text:
+    """
+    Собирает writable CTE для Postgres: upsert пользователей и вставка
+    нажатий одним стейтментом (один round-trip на весь батч).
+    """
+    # CAST(... AS ...) вместо ::-кастов: text() не распознает ":name::type"
+    # как bind-параметр (регэксп SQLAlchemy намеренно пропускает имя перед ::),
+    # и :tg_0 улетал в Postgres литеральным текстом
+    values_sql = ", ".join(
+        f"(CAST(:tg_{i} AS bigint), CAST(:un_{i} AS varchar), CAST(:fn_{i} AS varchar), "
+        f"CAST(:btn_{i} AS integer), CAST(:src_{i} AS varchar), CAST(:pid_{i} AS integer))"
+        for i in range(row_count)
+    )
+    return text(f"""
+        WITH input_rows(telegram_id, username, first_name, button_id, source, post_id) AS (
+            VALUES {values_sql}
+        ), upserted AS (
+            INSERT INTO users (telegram_id, username, first_name)
+            SELECT DISTINCT ON (telegram_id) telegram_id, username, first_name
+            FROM input_rows ORDER BY telegram_id
+            ON CONFLICT (telegram_id) DO UPDATE SET last_activity = now()
+            RETURNING id, telegram_id
+        )
+        INSERT INTO channel_button_clicks (user_id, telegram_id, button_id, source, post_id)
+        SELECT u.id, i.telegram_id, i.button_id, i.source, i.post_id
+        FROM input_rows i
+        JOIN upserted u ON u.telegram_id = i.telegram_id
+    """)
+
+
+async def _flush_batch(rows: list) -> None:
+    """Пишет батч нажатий в БД: upsert пользователей + вставка кликов."""
+    async with get_session() as session:
+        if session.bind.dialect.name == "postgresql":
+            # Один writable CTE: upsert + insert за один round-trip
+            params = {}
+            for i, row in enumerate(rows):
+                params[f"tg_{i}"] = row["telegram_id"]
+                params[f"un_{i}"] = row["username"]
+                params[f"fn_{i}"] = row["first_name"]
+                params[f"btn_{i}"] = row["button_id"]
+                params[f"src_{i}"] = row["source"]
+                params[f"pid_{i}"] = row["post_id"]
+            await session.execute(_build_cte_sql(len(rows)), params)
+            return
+
+        # SQLite (DEV_MODE): два стейтмента - upsert пользователей и вставка кликов
+        # Дедуплицируем пользователей в батче по telegram_id (первая запись выигрывает)
+        users = {}
+        for row in rows:
+            users.setdefault(row["telegram_id"], {
+                "telegram_id": row["telegram_id"],
+                "username": row["username"],
+                "first_name": row["first_name"],
+            })
+
+        await session.execute(
+            sqlite_insert(User)
+            .values(list(users.values()))
+            .on_conflict_do_nothing(index_elements=['telegram_id'])
+        )
+
+        # Резолвим user_id для всех пользователей батча одним SELECT
+        id_result = await session.execute(
+            select(User.id, User.telegram_id).where(User.telegram_id.in_(users))
+        )
+        id_map = {tg_id: user_id for user_id, tg_id in id_result}
+
+        click_rows = [
+            {
+                "user_id": id_map[row["telegram_id"]],
+                "telegram_id": row["telegram_id"],
+                "button_id": row["button_id"],
+                "source": row["source"],
+                "post_id": row["post_id"],
+            }
+            for row in rows if row["telegram_id"] in id_map
+        ]
+        if click_rows:
+            await session.execute(insert(ChannelButtonClick), click_rows)
+
+
+async def _flush_loop() -> None:
+    """Фоновый цикл: собирает нажатия из очереди и пишет их одним INSERT."""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Блокируемся до первого элемента, затем добираем батч до дедлайна
+        rows = [await clicks_queue.get()]
+        try:
+            deadline = loop.time() + FLUSH_INTERVAL
+            while len(rows) < MAX_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(clicks_queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await _flush_batch(rows)
+            logger.debug("Flushed %d click(s) to DB", len(rows))
+        except asyncio.CancelledError:
+            # Возвращаем недописанный батч в очередь - финальный слив
+            # в stop_click_batcher его подхватит
+            for row in rows:
+                clicks_queue.put_nowait(row)
+            raise
+        except Exception as e:
+            logger.error("Error flushing click batch (%d rows): %s", len(rows), e)
+
+
+def start_click_batcher() -> None:
+    """Запускает фоновую задачу батчера. Вызывается после init_db()."""
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop())
+        logger.info("✅ Click batcher started")
+
+
+async def stop_click_batcher() -> None:
+    """Останавливает фоновую задачу батчера и дописывает остаток очереди."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+
+    # Финальный слив: всё, что осталось в очереди (включая батч, который
+    # отменённый цикл вернул обратно) - иначе каждый рестарт молча
+    # терял поставленные в очередь нажатия
+    while not clicks_queue.empty():
+        rows = []
+        while not clicks_queue.empty() and len(rows) < MAX_BATCH_SIZE:
+            rows.append(clicks_queue.get_nowait())
+        try:
+            await _flush_batch(rows)
+        except Exception as e:
+            logger.error("Error flushing %d click(s) on shutdown: %s", len(rows), e)
+            break
+    logger.info("Click batcher stopped")
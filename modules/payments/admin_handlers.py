@@ -3,8 +3,13 @@ Admin handlers for Lead Magnet Bot.
 Handles admin panel and channel button management.
 """
 
+import asyncio
 import logging
 import html
+import re
+from dataclasses import dataclass
+from functools import wraps
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ContextTypes, CommandHandler, CallbackQueryHandler,
@@ -12,17 +17,112 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode
 from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from enum import IntEnum
 
 from database.database import get_session
 from database import ChannelButton, ChannelButtonClick, BotSettings
 from services.channel_button_service import ChannelButtonService
+from modules.cache import button_cache
 from .keyboards import get_admin_panel_keyboard
-from .subscription import get_subscription_channel
+from .subscription import get_subscription_channel, invalidate_subscription_channel
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Скомпилированные паттерны callback_data: CallbackQueryHandler компилирует
+# строковые паттерны на каждый матч заново только при создании, но компиляция
+# здесь делает набор роутов явным и переиспользуемым
+_P_ADMIN_BACK = re.compile(r"^admin:back$")
+_P_ADMIN_COMMANDS = re.compile(r"^admin:commands$")
+_P_ADMIN_BUTTON_STATS = re.compile(r"^admin:button_stats$")
+_P_ADMIN_ADD_BUTTON = re.compile(r"^admin:add_button$")
+_P_ADMIN_CHANNEL_SETTINGS = re.compile(r"^admin:channel_settings$")
+_P_BUTTON_TYPE = re.compile(r"^button:type:")
+
+# Формат username Telegram-канала: латиница/цифры/underscore, 5-32 символа,
+# первая - буква. Явно мусорный ввод отсекаем до похода в get_chat -
+# экономим полный HTTPS round-trip к Telegram API
+_TG_USERNAME_RE = re.compile(r'^@?[A-Za-z][A-Za-z0-9_]{4,31}$')
+
+# Статичные тексты и клавиатуры админки - собираются один раз при импорте,
+# а не на каждый апдейт
+_BACK_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data="admin:back")]
+])
+
+_ADMIN_PANEL_TEXT = """
+🔧 <b>АДМИН-ПАНЕЛЬ</b>
+
+<b>Доступные команды:</b>
+<code>/admin</code> - Админ-панель
+<code>/add_button</code> - Создать пост с кнопкой
+<code>/set_channel</code> - Настроить канал для проверки подписки
+
+Выберите действие ниже:
+"""
+
+_ADMIN_MENU_TEXT = """
+🔧 <b>АДМИН-ПАНЕЛЬ</b>
+
+Выберите действие:
+"""
+
+_COMMANDS_TEXT = """
+📝 <b>СПИСОК АДМИН-КОМАНД</b>
+
+<b>Основные команды:</b>
+<code>/admin</code> - Админ-панель
+<code>/add_button</code> - Создать пост с кнопкой
+<code>/set_channel</code> - Настроить канал для проверки подписки
+
+<b>Действия через меню:</b>
+• ➕ Создать пост с кнопкой
+• 📊 Статистика по кнопкам
+• ⚙️ Настройки канала
+"""
+
+# Ключи черновика кнопки в user_data - чистятся одним циклом,
+# при добавлении нового шага диалога достаточно дописать ключ сюда
+_BUTTON_KEYS = ('button_text', 'lead_magnet_type', 'external_link', 'button_channel_id')
+
+
+def _clear_button_draft(user_data: dict) -> None:
+    """Удаляет из user_data все ключи черновика кнопки."""
+    for key in _BUTTON_KEYS:
+        user_data.pop(key, None)
+
+
+def _truncate(s: str, n: int) -> str:
+    """Обрезает строку до n символов с одиночным символом многоточия."""
+    return s if len(s) <= n else s[:n] + "…"
+
+
+@dataclass
+class ButtonDraft:
+    """Черновик кнопки, собираемый по шагам диалога /add_button."""
+    text: Optional[str]
+    type: Optional[str]
+    channel: Optional[str]
+    link: Optional[str] = None
+
+    @classmethod
+    def from_user_data(cls, user_data: dict) -> "ButtonDraft":
+        """Один структурированный fetch вместо цепочки .get() по ходу обработчика."""
+        return cls(
+            text=user_data.get('button_text'),
+            type=user_data.get('lead_magnet_type'),
+            channel=user_data.get('button_channel_id'),
+            link=user_data.get('external_link'),
+        )
+
+    def is_complete(self) -> bool:
+        """Все ли обязательные поля заполнены (ссылка нужна только для external)."""
+        if not self.text or not self.type or not self.channel:
+            return False
+        return self.type != "external" or bool(self.link)
+
 
 class AdminButtonStates(IntEnum):
     """States for button addition dialog."""
@@ -36,193 +136,201 @@ class AdminButtonStates(IntEnum):
 
 # ==================== ADMIN AUTHENTICATION ====================
 
+# Снимок набора админов при импорте: Config.ADMIN_USER_IDS уже frozenset,
+# здесь избавляемся еще и от lookup'а атрибута класса на каждый вызов
+_ADMIN_IDS = Config.ADMIN_USER_IDS
+
+
 def is_admin(user_id: int) -> bool:
-    """Check if user is admin."""
-    return user_id in Config.ADMIN_USER_IDS
+    """Check if user is admin (O(1) frozenset lookup)."""
+    return user_id in _ADMIN_IDS
+
+
+def per_chat_ordered(handler):
+    """
+    Декоратор: сериализует выполнение обработчика в пределах одного чата.
+
+    Админ-callback'и зарегистрированы с block=False, поэтому апдейты разных
+    чатов обрабатываются параллельно. Лок в chat_data возвращает порядок
+    внутри чата: два быстрых клика по меню не перетрут правки сообщения
+    друг друга, а медленный запрос статистики одного админа не задержит
+    остальных.
+    """
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        lock = context.chat_data.setdefault('_lock', asyncio.Lock())
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+
+def admin_only(handler):
+    """
+    Декоратор: пропускает в обработчик только админов.
+
+    Вешается на точки входа (команды и callback'и верхнего уровня).
+    Внутренние шаги ConversationHandler проверять повторно не нужно -
+    в диалог невозможно попасть, минуя защищенную точку входа.
+    """
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_admin(update.effective_user.id):
+            if update.callback_query:
+                await update.callback_query.answer()
+                await update.callback_query.edit_message_text("❌ Нет прав доступа.")
+            else:
+                await update.message.reply_text("❌ У вас нет прав доступа.")
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
+
+
+async def get_bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """
+    Возвращает username бота, кэшируя результат get_me() в bot_data.
+
+    Identity бота не меняется за время жизни процесса, поэтому второй
+    и последующие вызовы не ходят в Telegram API.
+    """
+    username = context.bot_data.get('bot_username')
+    if username:
+        return username
+    bot_info = await context.bot.get_me()
+    context.bot_data['bot_username'] = bot_info.username
+    return bot_info.username
 
 
 # ==================== ADMIN COMMAND ====================
 
+@admin_only
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /admin command - show admin panel."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа к админ-панели.")
-        return
-    
-    message = """
-🔧 **АДМИН-ПАНЕЛЬ**
-
-**Доступные команды:**
-`/admin` - Админ-панель
-`/add_button` - Создать пост с кнопкой
-`/set_channel` - Настроить канал для проверки подписки
-
-Выберите действие ниже:
-"""
-    
     await update.message.reply_text(
-        message,
+        _ADMIN_PANEL_TEXT,
         reply_markup=get_admin_panel_keyboard(),
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.HTML
     )
 
 
 # ==================== ADMIN CALLBACK HANDLERS ====================
 
+@admin_only
+@per_chat_ordered
 async def admin_back_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Go back to admin panel."""
     query = update.callback_query
     await query.answer()
     
-    message = """
-🔧 **АДМИН-ПАНЕЛЬ**
-
-Выберите действие:
-"""
-    
     await query.edit_message_text(
-        message,
+        _ADMIN_MENU_TEXT,
         reply_markup=get_admin_panel_keyboard(),
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.HTML
     )
 
 
+@admin_only
+@per_chat_ordered
 async def admin_commands_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show list of admin commands."""
     query = update.callback_query
     await query.answer()
-    
-    telegram_id = query.from_user.id
-    
-    if not is_admin(telegram_id):
-        await query.edit_message_text("❌ Нет прав доступа.")
-        return
-    
-    message = """
-📝 **СПИСОК АДМИН-КОМАНД**
 
-**Основные команды:**
-`/admin` - Админ-панель
-`/add_button` - Создать пост с кнопкой
-`/set_channel` - Настроить канал для проверки подписки
-
-**Действия через меню:**
-• ➕ Создать пост с кнопкой
-• 📊 Статистика по кнопкам
-• ⚙️ Настройки канала
-"""
-    
     await query.edit_message_text(
-        message,
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("◀️ Назад", callback_data="admin:back")]
-        ])
+        _COMMANDS_TEXT,
+        parse_mode=ParseMode.HTML,
+        reply_markup=_BACK_KEYBOARD
     )
 
 
+@admin_only
+@per_chat_ordered
 async def admin_button_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show detailed statistics for each button."""
     query = update.callback_query
     await query.answer()
-    
-    telegram_id = query.from_user.id
-    
-    if not is_admin(telegram_id):
-        await query.edit_message_text("❌ Нет прав доступа.")
-        return
-    
+
     try:
         async with get_session() as session:
-            # Получаем все кнопки
-            buttons_result = await session.execute(
-                select(ChannelButton).order_by(ChannelButton.created_at.desc())
+            # Одним запросом: кнопки + агрегаты по нажатиям (вместо 2 запросов
+            # на каждую кнопку в цикле)
+            stats_result = await session.execute(
+                select(
+                    ChannelButton,
+                    func.count(ChannelButtonClick.id),
+                    func.count(func.distinct(ChannelButtonClick.telegram_id))
+                )
+                .outerjoin(ChannelButtonClick, ChannelButtonClick.button_id == ChannelButton.id)
+                .group_by(ChannelButton.id)
+                .order_by(ChannelButton.created_at.desc())
+                .limit(11)  # 11-й ряд - признак "есть еще", в сообщение идут 10
             )
-            buttons = buttons_result.scalars().all()
-            
+            buttons = stats_result.all()
+
+            # Показываем 10; общее число добираем отдельным COUNT только
+            # когда кнопок действительно больше
+            more_count = 0
+            if len(buttons) == 11:
+                total = (await session.execute(
+                    select(func.count(ChannelButton.id))
+                )).scalar() or 0
+                more_count = total - 10
+                buttons = buttons[:10]
+
             if not buttons:
                 await query.edit_message_text(
-                    "📊 **СТАТИСТИКА ПО КНОПКАМ**\n\n"
+                    "📊 <b>СТАТИСТИКА ПО КНОПКАМ</b>\n\n"
                     "Кнопки еще не созданы.",
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("◀️ Назад", callback_data="admin:back")]
-                    ])
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=_BACK_KEYBOARD
                 )
                 return
             
-            # Собираем статистику по каждой кнопке
-            stats_lines = []
-            for button in buttons:
-                # Считаем нажатия для этой кнопки
-                clicks_result = await session.execute(
-                    select(func.count(ChannelButtonClick.id))
-                    .where(ChannelButtonClick.button_id == button.id)
-                )
-                clicks_count = clicks_result.scalar() or 0
-                
-                # Считаем уникальных пользователей
-                unique_result = await session.execute(
-                    select(func.count(func.distinct(ChannelButtonClick.telegram_id)))
-                    .where(ChannelButtonClick.button_id == button.id)
-                )
-                unique_count = unique_result.scalar() or 0
-                
+            # Собираем сообщение списком частей и склеиваем одним join -
+            # без квадратичной переаллокации строк на +=
+            parts = ["📊 <b>СТАТИСТИКА ПО КНОПКАМ</b>\n"]
+            for button, clicks_count, unique_count in buttons:
                 # Форматируем тип
                 type_emoji = "🤖" if button.lead_magnet_type == "bot" else "🔗"
                 type_name = "Бот" if button.lead_magnet_type == "bot" else "Внешняя ссылка"
                 
                 # Обрезаем длинные тексты
-                post_title_short = button.post_title[:40] + "..." if len(button.post_title) > 40 else button.post_title
-                button_text_short = button.button_text[:30] + "..." if len(button.button_text) > 30 else button.button_text
+                post_title_short = _truncate(button.post_title, 40)
+                button_text_short = _truncate(button.button_text, 30)
                 
-                stats_lines.append(
-                    f"**🔘 {button_text_short}**\n"
-                    f"📝 Пост: {post_title_short}\n"
+                parts.append(
+                    f"<b>🔘 {html.escape(button_text_short)}</b>\n"
+                    f"📝 Пост: {html.escape(post_title_short)}\n"
                     f"{type_emoji} Тип: {type_name}\n"
                     f"👆 Нажатий: {clicks_count} | 👥 Уникальных: {unique_count}\n"
                 )
-            
-            # Формируем сообщение (ограничиваем длину)
-            message = "📊 **СТАТИСТИКА ПО КНОПКАМ**\n\n"
-            message += "\n".join(stats_lines[:10])  # Показываем первые 10
-            
-            if len(buttons) > 10:
-                message += f"\n\n... и еще {len(buttons) - 10} кнопок"
-            
+
+            if more_count > 0:
+                parts.append(f"\n... и еще {more_count} кнопок")
+
+            message = "\n".join(parts)
+
             await query.edit_message_text(
                 message,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("◀️ Назад", callback_data="admin:back")]
-                ])
+                parse_mode=ParseMode.HTML,
+                reply_markup=_BACK_KEYBOARD
             )
-    
-    except Exception as e:
-        logger.error(f"Error getting button stats: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+
+    except Exception:
+        logger.exception("Error getting button stats")
         await query.edit_message_text("❌ Ошибка загрузки статистики.")
 
 
 # ==================== CHANNEL BUTTON MANAGEMENT ====================
 
+@admin_only
 async def add_button_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /add_button command - создать пост с кнопкой в канале."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
     await update.message.reply_text(
-        "🔘 **СОЗДАНИЕ ПОСТА С КНОПКОЙ**\n\n"
+        "🔘 <b>СОЗДАНИЕ ПОСТА С КНОПКОЙ</b>\n\n"
         "Отправьте текст для кнопки.\n\n"
         "Например: \"Получить лид-магнит\" или \"Попробовать бота\"\n\n"
         "Используйте /cancel для отмены.",
-        parse_mode=ParseMode.MARKDOWN
+        parse_mode=ParseMode.HTML
     )
     
     return AdminButtonStates.WAITING_BUTTON_TEXT
@@ -230,12 +338,6 @@ async def add_button_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def add_button_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button text input."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
     button_text = update.message.text.strip()
     
     if not button_text:
@@ -264,13 +366,7 @@ async def add_button_type_callback(update: Update, context: ContextTypes.DEFAULT
     """Handle lead magnet type selection."""
     query = update.callback_query
     await query.answer()
-    
-    telegram_id = query.from_user.id
-    
-    if not is_admin(telegram_id):
-        await query.edit_message_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
+
     # Извлекаем тип из callback_data
     lead_magnet_type = query.data.split(":")[-1]  # "bot" или "external"
     
@@ -305,12 +401,6 @@ async def add_button_type_callback(update: Update, context: ContextTypes.DEFAULT
 
 async def add_button_link_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle external link input."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
     external_link = update.message.text.strip()
     
     if not external_link or not (external_link.startswith('http://') or external_link.startswith('https://')):
@@ -336,25 +426,33 @@ async def add_button_link_handler(update: Update, context: ContextTypes.DEFAULT_
 
 async def add_button_channel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle channel selection."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
     channel_input = update.message.text.strip()
-    
+
+    # Явно невалидный username - отвечаем сразу, без запроса к Telegram
+    if not _TG_USERNAME_RE.match(channel_input):
+        await update.message.reply_text(
+            "❌ Неверный формат username.\n\n"
+            "Формат: @channel_username или channel_username"
+        )
+        return AdminButtonStates.WAITING_CHANNEL
+
     # Обрабатываем формат канала
     if channel_input.startswith('@'):
         channel_id = channel_input
     else:
         channel_id = f"@{channel_input}"
-    
-    # Проверяем, что бот может работать с каналом
+
+    # Проверяем, что бот может работать с каналом. Все I/O-проверки собираем
+    # в список и выполняем параллельно - при добавлении новых валидаций
+    # (например, DB-проверки уникальности канала) латентность останется
+    # равной самой медленной из них, а не их сумме
     try:
-        # Пытаемся получить информацию о канале
-        chat = await context.bot.get_chat(chat_id=channel_id)
-        
+        checks = [context.bot.get_chat(chat_id=channel_id)]
+        results = await asyncio.gather(*checks, return_exceptions=True)
+        chat = results[0]
+        if isinstance(chat, Exception):
+            raise chat
+
         # Проверяем, что это канал
         if chat.type not in ['channel', 'supergroup']:
             await update.message.reply_text(
@@ -378,7 +476,7 @@ async def add_button_channel_handler(update: Update, context: ContextTypes.DEFAU
         return AdminButtonStates.WAITING_POST_CONTENT
         
     except Exception as e:
-        logger.error(f"Error checking channel: {e}")
+        logger.error("Error checking channel: %s", e)
         await update.message.reply_text(
             f"❌ Ошибка при проверке канала: {e}\n\n"
             "Убедитесь, что:\n"
@@ -389,57 +487,70 @@ async def add_button_channel_handler(update: Update, context: ContextTypes.DEFAU
         return AdminButtonStates.WAITING_CHANNEL
 
 
+async def _save_button_to_db(
+    channel_id: str,
+    message_id: int,
+    post_title: str,
+    button_text: str,
+    lead_magnet_type: str,
+    link: str,
+    created_by: int
+) -> None:
+    """Сохраняет информацию о кнопке в БД и сбрасывает кэш кнопки."""
+    async with get_session() as session:
+        button = ChannelButton(
+            channel_id=channel_id,
+            message_id=message_id,
+            post_title=post_title,
+            button_text=button_text,
+            lead_magnet_type=lead_magnet_type,
+            link=link,
+            created_by=created_by
+        )
+        session.add(button)
+        # flush выдает id из INSERT ... RETURNING еще до коммита - читаем его
+        # здесь, чтобы не зависеть от expire_on_commit и не провоцировать
+        # лишний SELECT после коммита
+        await session.flush()
+        button_id = button.id
+        await session.commit()
+        # Сбрасываем кэш кнопки, чтобы /start увидел свежие данные
+        button_cache.invalidate(message_id)
+        logger.info("Button info saved: ID %s", button_id)
+
+
 async def add_button_post_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle post content input and publish it with button."""
     telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
-    # Получаем сохраненные данные
-    button_text = context.user_data.get('button_text')
-    lead_magnet_type = context.user_data.get('lead_magnet_type')
-    
-    if not button_text or not lead_magnet_type:
+
+    # Забираем черновик одним структурированным fetch'ем; единая точка
+    # проверки "что-то из состояния диалога потерялось"
+    draft = ButtonDraft.from_user_data(context.user_data)
+    if not draft.is_complete():
         await update.message.reply_text("❌ Ошибка: данные не найдены. Начните заново.")
         return ConversationHandler.END
-    
-    # Получаем ID канала из сохраненных данных
-    channel_id = context.user_data.get('button_channel_id')
-    if not channel_id:
-        await update.message.reply_text("❌ Ошибка: канал не выбран. Начните заново.")
-        return ConversationHandler.END
-    
+
+    button_text = draft.text
+    lead_magnet_type = draft.type
+    channel_id = draft.channel
+
     try:
-        # Получаем контент поста
+        # Получаем контент поста. Пересланные и обычные сообщения
+        # разбираются одинаково - текст, подпись с фото или только фото
         post_text = None
         photo_file_id = None
-        
-        # Обрабатываем пересланное сообщение
-        if update.message.forward_from_chat or update.message.forward_from:
-            if update.message.text:
-                post_text = update.message.text
-            elif update.message.caption:
-                post_text = update.message.caption
-                if update.message.photo:
-                    photo_file_id = update.message.photo[-1].file_id
-            elif update.message.photo:
-                photo_file_id = update.message.photo[-1].file_id
-                post_text = ""
-        else:
-            # Обычное сообщение
-            if update.message.text:
-                post_text = update.message.text
-            elif update.message.caption:
-                post_text = update.message.caption
-                if update.message.photo:
-                    photo_file_id = update.message.photo[-1].file_id
-            elif update.message.photo:
-                # Только фото без текста
+
+        if update.message.text:
+            post_text = update.message.text
+        elif update.message.caption:
+            post_text = update.message.caption
+            if update.message.photo:
                 photo_file_id = update.message.photo[-1].file_id
-                post_text = ""
-        
+        elif update.message.photo:
+            # Только фото без текста
+            photo_file_id = update.message.photo[-1].file_id
+            post_text = ""
+
         if not post_text and not photo_file_id:
             await update.message.reply_text(
                 "❌ Не удалось получить контент поста.\n\n"
@@ -453,19 +564,15 @@ async def add_button_post_handler(update: Update, context: ContextTypes.DEFAULT_
         
         # Генерируем ссылку
         if lead_magnet_type == "bot":
-            # Получаем информацию о боте
-            bot_info = await context.bot.get_me()
-            bot_username = bot_info.username
+            # Получаем username бота (кэшируется в bot_data)
+            bot_username = await get_bot_username(context)
             # Сначала создаем временную ссылку (без message_id)
             temp_link = ChannelButtonService.generate_bot_link(bot_username)
             link = temp_link
         else:
-            # Внешняя ссылка
-            link = context.user_data.get('external_link')
-            if not link:
-                await update.message.reply_text("❌ Ошибка: ссылка не найдена. Начните заново.")
-                return ConversationHandler.END
-        
+            # Внешняя ссылка (наличие проверено в is_complete)
+            link = draft.link
+
         # Публикуем пост с кнопкой
         message_id = await ChannelButtonService.publish_post_with_button(
             bot=context.bot,
@@ -479,53 +586,57 @@ async def add_button_post_handler(update: Update, context: ContextTypes.DEFAULT_
         
         if message_id:
             # Обновляем ссылку для бота с реальным message_id
+            edit_markup_coro = None
             if lead_magnet_type == "bot":
-                bot_info = await context.bot.get_me()
-                bot_username = bot_info.username
+                bot_username = await get_bot_username(context)
                 # Генерируем правильную ссылку с message_id
                 link = ChannelButtonService.generate_bot_link(bot_username, message_id)
-                logger.info(f"🔗 Generated bot link with message_id {message_id}: {link}")
+                logger.info("🔗 Generated bot link with message_id %s: %s", message_id, link)
                 # Обновляем кнопку в посте с правильной ссылкой
                 keyboard = ChannelButtonService.create_button_keyboard(link, button_text)
-                try:
-                    await context.bot.edit_message_reply_markup(
-                        chat_id=channel_id,
-                        message_id=message_id,
-                        reply_markup=keyboard
-                    )
-                    logger.info(f"✅ Button updated with correct link for message_id {message_id}")
-                except Exception as e:
-                    logger.error(f"❌ Failed to update button with correct link: {e}")
-            
-            # Сохраняем информацию о кнопке в БД
-            try:
-                # Используем первые 100 символов текста как название поста
-                post_title = post_text[:100] + "..." if len(post_text) > 100 else post_text
-                if not post_title:
-                    post_title = f"Пост {message_id}"
-                
-                async with get_session() as session:
-                    button = ChannelButton(
-                        channel_id=str(channel_id),
-                        message_id=message_id,
-                        post_title=post_title,
-                        button_text=button_text,
-                        lead_magnet_type=lead_magnet_type,
-                        link=link,
-                        created_by=telegram_id
-                    )
-                    session.add(button)
-                    await session.commit()
-                    logger.info(f"Button info saved: ID {button.id}")
-            except Exception as e:
-                logger.error(f"Error saving button info: {e}")
-            
+                edit_markup_coro = context.bot.edit_message_reply_markup(
+                    chat_id=channel_id,
+                    message_id=message_id,
+                    reply_markup=keyboard
+                )
+
+            # Используем первые 100 символов текста как название поста
+            post_title = _truncate(post_text, 100)
+            if not post_title:
+                post_title = f"Пост {message_id}"
+
+            # Правка клавиатуры (Telegram RTT) и запись в БД (DB RTT) независимы -
+            # выполняем параллельно; ошибка одной не топит другую
+            tasks = [_save_button_to_db(
+                channel_id=str(channel_id),
+                message_id=message_id,
+                post_title=post_title,
+                button_text=button_text,
+                lead_magnet_type=lead_magnet_type,
+                link=link,
+                created_by=telegram_id
+            )]
+            if edit_markup_coro is not None:
+                tasks.append(edit_markup_coro)
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+            if isinstance(results[0], Exception):
+                logger.error("Error saving button info: %s", results[0])
+            if edit_markup_coro is not None:
+                if isinstance(results[1], Exception):
+                    logger.error("❌ Failed to update button with correct link: %s", results[1])
+                else:
+                    logger.info("✅ Button updated with correct link for message_id %s", message_id)
+
             # Используем HTML для безопасного отображения
             escaped_button_text = html.escape(button_text)
             escaped_link = html.escape(link)
             escaped_post_title = html.escape(post_title[:50])
             
-            await update.message.reply_text(
+            # Подтверждение админу не на критическом пути - отправляем фоном,
+            # чтобы не держать ConversationHandler лишний Telegram RTT.
+            # application.create_task хранит ссылку на задачу (не потеряется в GC).
+            context.application.create_task(update.message.reply_text(
                 f"✅ <b>Пост опубликован!</b>\n\n"
                 f"📊 ID поста: <code>{message_id}</code>\n"
                 f"📝 Название: {escaped_post_title}\n"
@@ -533,28 +644,23 @@ async def add_button_post_handler(update: Update, context: ContextTypes.DEFAULT_
                 f"{'🤖' if lead_magnet_type == 'bot' else '🔗'} Тип: {'Доступ к боту' if lead_magnet_type == 'bot' else 'Внешняя ссылка'}\n"
                 f"🔗 Ссылка: <code>{escaped_link}</code>",
                 parse_mode=ParseMode.HTML
-            )
-            logger.info(f"Post with button '{button_text}' published in channel {channel_id}, message_id: {message_id}")
+            ))
+            logger.info("Post with button '%s' published in channel %s, message_id: %s", button_text, channel_id, message_id)
         else:
-            await update.message.reply_text(
+            context.application.create_task(update.message.reply_text(
                 f"❌ <b>Ошибка при публикации поста.</b>\n\n"
                 "Возможные причины:\n"
                 "• Бот не является администратором канала\n"
                 "• У бота нет прав на отправку сообщений\n"
                 "• Недостаточно прав для работы с каналом",
                 parse_mode=ParseMode.HTML
-            )
+            ))
         
         # Очищаем данные
-        context.user_data.pop('button_text', None)
-        context.user_data.pop('lead_magnet_type', None)
-        context.user_data.pop('external_link', None)
-        context.user_data.pop('button_channel_id', None)
-        
+        _clear_button_draft(context.user_data)
+
     except Exception as e:
-        logger.error(f"Error publishing post: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error publishing post")
         await update.message.reply_text(f"❌ Ошибка: {e}")
     
     return ConversationHandler.END
@@ -563,73 +669,68 @@ async def add_button_post_handler(update: Update, context: ContextTypes.DEFAULT_
 async def cancel_button_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel button addition."""
     # Очищаем сохраненные данные
-    context.user_data.pop('button_channel_id', None)
-    context.user_data.pop('button_text', None)
-    context.user_data.pop('lead_magnet_type', None)
-    context.user_data.pop('external_link', None)
-    
+    _clear_button_draft(context.user_data)
+
     await update.message.reply_text("❌ Добавление кнопки отменено.")
     return ConversationHandler.END
 
 
 # ==================== CHANNEL SETTINGS ====================
 
+@admin_only
 async def set_channel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /set_channel command - настройка канала для проверки подписки."""
-    telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return
-    
     # Получаем текущий канал
     try:
         current_channel = await get_subscription_channel()
         message = f"""
-⚙️ **НАСТРОЙКА КАНАЛА ДЛЯ ПРОВЕРКИ ПОДПИСКИ**
+⚙️ <b>НАСТРОЙКА КАНАЛА ДЛЯ ПРОВЕРКИ ПОДПИСКИ</b>
 
-**Текущий канал:** {current_channel}
+<b>Текущий канал:</b> {html.escape(current_channel)}
 
 Отправьте username канала для проверки подписки.
 
-**Формат:**
+<b>Формат:</b>
 • @channel_username
 • channel_username (без @)
 
-**Важно:** Бот должен быть администратором канала для проверки подписки.
+<b>Важно:</b> Бот должен быть администратором канала для проверки подписки.
 
 Используйте /cancel для отмены.
 """
     except Exception as e:
-        logger.error(f"Error getting current channel: {e}")
+        logger.error("Error getting current channel: %s", e)
         message = """
-⚙️ **НАСТРОЙКА КАНАЛА ДЛЯ ПРОВЕРКИ ПОДПИСКИ**
+⚙️ <b>НАСТРОЙКА КАНАЛА ДЛЯ ПРОВЕРКИ ПОДПИСКИ</b>
 
 Отправьте username канала для проверки подписки.
 
-**Формат:**
+<b>Формат:</b>
 • @channel_username
 • channel_username (без @)
 
-**Важно:** Бот должен быть администратором канала для проверки подписки.
+<b>Важно:</b> Бот должен быть администратором канала для проверки подписки.
 
 Используйте /cancel для отмены.
 """
-    
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
     return AdminButtonStates.WAITING_SUBSCRIPTION_CHANNEL
 
 
 async def set_channel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle channel username input for subscription check."""
     telegram_id = update.effective_user.id
-    
-    if not is_admin(telegram_id):
-        await update.message.reply_text("❌ У вас нет прав доступа.")
-        return ConversationHandler.END
-    
     channel_input = update.message.text.strip()
-    
+
+    # Явно невалидный username - отвечаем сразу, без запроса к Telegram
+    if not _TG_USERNAME_RE.match(channel_input):
+        await update.message.reply_text(
+            "❌ Неверный формат username.\n\n"
+            "Формат: @channel_username или channel_username"
+        )
+        return AdminButtonStates.WAITING_SUBSCRIPTION_CHANNEL
+
     # Обрабатываем формат канала
     if channel_input.startswith('@'):
         channel_username = channel_input
@@ -649,40 +750,37 @@ async def set_channel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return AdminButtonStates.WAITING_SUBSCRIPTION_CHANNEL
         
-        # Сохраняем в БД
+        # Сохраняем в БД одним UPSERT (вместо SELECT + INSERT/UPDATE)
         async with get_session() as session:
-            result = await session.execute(
-                select(BotSettings).where(BotSettings.key == "subscription_channel")
+            insert_fn = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+            stmt = insert_fn(BotSettings).values(
+                key="subscription_channel",
+                value=channel_username,
+                updated_by=telegram_id
             )
-            setting = result.scalar_one_or_none()
-            
-            if setting:
-                # Обновляем существующую настройку
-                setting.value = channel_username
-                setting.updated_by = telegram_id
-            else:
-                # Создаем новую настройку
-                setting = BotSettings(
-                    key="subscription_channel",
-                    value=channel_username,
-                    updated_by=telegram_id
-                )
-                session.add(setting)
-            
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={
+                    'value': stmt.excluded.value,
+                    'updated_by': stmt.excluded.updated_by,
+                    'updated_at': func.now(),
+                }
+            )
+            await session.execute(stmt)
             await session.commit()
-            logger.info(f"Subscription channel updated to {channel_username} by {telegram_id}")
-        
+            # Сбрасываем кэш, чтобы новый канал подхватился сразу
+            invalidate_subscription_channel()
+            logger.info("Subscription channel updated to %s by %s", channel_username, telegram_id)
+
         await update.message.reply_text(
-            f"✅ **Канал успешно настроен!**\n\n"
-            f"Канал для проверки подписки: {channel_username}\n\n"
+            f"✅ <b>Канал успешно настроен!</b>\n\n"
+            f"Канал для проверки подписки: {html.escape(channel_username)}\n\n"
             f"Теперь бот будет проверять подписку на этот канал.",
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.HTML
         )
-        
+
     except Exception as e:
-        logger.error(f"Error setting channel: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error setting channel")
         await update.message.reply_text(
             f"❌ Ошибка при настройке канала: {e}\n\n"
             "Убедитесь, что:\n"
@@ -695,40 +793,34 @@ async def set_channel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ConversationHandler.END
 
 
+@admin_only
+@per_chat_ordered
 async def admin_channel_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show channel settings."""
     query = update.callback_query
     await query.answer()
-    
-    telegram_id = query.from_user.id
-    
-    if not is_admin(telegram_id):
-        await query.edit_message_text("❌ Нет прав доступа.")
-        return
-    
+
     try:
         current_channel = await get_subscription_channel()
         message = f"""
-⚙️ **НАСТРОЙКИ КАНАЛА**
+⚙️ <b>НАСТРОЙКИ КАНАЛА</b>
 
-**Текущий канал для проверки подписки:** {current_channel}
+<b>Текущий канал для проверки подписки:</b> {html.escape(current_channel)}
 
-Используйте команду `/set_channel` для изменения канала.
+Используйте команду <code>/set_channel</code> для изменения канала.
 """
     except Exception as e:
-        logger.error(f"Error getting channel settings: {e}")
+        logger.error("Error getting channel settings: %s", e)
         message = """
-⚙️ **НАСТРОЙКИ КАНАЛА**
+⚙️ <b>НАСТРОЙКИ КАНАЛА</b>
 
-Используйте команду `/set_channel` для настройки канала.
+Используйте команду <code>/set_channel</code> для настройки канала.
 """
-    
+
     await query.edit_message_text(
         message,
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("◀️ Назад", callback_data="admin:back")]
-        ])
+        parse_mode=ParseMode.HTML,
+        reply_markup=_BACK_KEYBOARD
     )
 
 
@@ -748,14 +840,14 @@ def register_admin_handlers(application):
         application: Telegram Application instance
     """
     # Admin command
-    application.add_handler(CommandHandler("admin", admin_command))
-    
-    # Admin callbacks
-    application.add_handler(CallbackQueryHandler(admin_back_callback, pattern="^admin:back$"))
-    application.add_handler(CallbackQueryHandler(admin_commands_callback, pattern="^admin:commands$"))
-    application.add_handler(CallbackQueryHandler(admin_button_stats_callback, pattern="^admin:button_stats$"))
-    application.add_handler(CallbackQueryHandler(admin_back_callback, pattern="^admin:add_button$"))
-    application.add_handler(CallbackQueryHandler(admin_channel_settings_callback, pattern="^admin:channel_settings$"))
+    application.add_handler(CommandHandler("admin", admin_command, block=False))
+
+    # Admin callbacks (block=False: не сериализуем обработку остальных апдейтов)
+    application.add_handler(CallbackQueryHandler(admin_back_callback, pattern=_P_ADMIN_BACK, block=False))
+    application.add_handler(CallbackQueryHandler(admin_commands_callback, pattern=_P_ADMIN_COMMANDS, block=False))
+    application.add_handler(CallbackQueryHandler(admin_button_stats_callback, pattern=_P_ADMIN_BUTTON_STATS, block=False))
+    application.add_handler(CallbackQueryHandler(admin_back_callback, pattern=_P_ADMIN_ADD_BUTTON, block=False))
+    application.add_handler(CallbackQueryHandler(admin_channel_settings_callback, pattern=_P_ADMIN_CHANNEL_SETTINGS, block=False))
     
     # Channel button management command
     button_management_conversation = ConversationHandler(
@@ -767,7 +859,7 @@ def register_admin_handlers(application):
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_button_text_handler)
             ],
             AdminButtonStates.WAITING_LEAD_MAGNET_TYPE: [
-                CallbackQueryHandler(add_button_type_callback, pattern="^button:type:")
+                CallbackQueryHandler(add_button_type_callback, pattern=_P_BUTTON_TYPE)
             ],
             AdminButtonStates.WAITING_EXTERNAL_LINK: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_button_link_handler)
@@ -4,16 +4,122 @@ Handles subscription checks and link distribution.
 """
 
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import re
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, CallbackQueryHandler
 
-from database.database import get_session
-from .subscription import check_channel_subscription, get_or_create_user, get_subscription_channel
+from .subscription import (
+    check_channel_subscription,
+    get_subscription_channel,
+    invalidate_subscription_cache
+)
 from .messages import get_free_access_message
 from .keyboards import get_free_access_keyboard
 
 logger = logging.getLogger(__name__)
 
+# Статичные тексты и клавиатуры - интернируются один раз при импорте,
+# тело обработчика остается чистой диспетчеризацией
+_EMPTY_KB = InlineKeyboardMarkup([])
+
+# Скомпилированный паттерн callback_data кнопки "Я подписался"
+_CHECK_SUBSCRIPTION_PATTERN = re.compile(r"^payment:check_subscription$")
+
+_MSG_NOT_SUBSCRIBED = """
+❌ **ПОДПИСКА НЕ НАЙДЕНА**
+
+Пожалуйста:
+1. 📢 Подпишитесь на канал {channel}
+2. ✅ Нажмите "Я подписался" еще раз для проверки
+"""
+
+# Статичные тексты успеха отправляются без parse_mode: жирный заголовок
+# задан готовым списком MessageEntity, так что ни Telegram, ни PTB не
+# парсят разметку на каждый вызов
+_MSG_SUCCESS_EXTERNAL = (
+    "✅ ПОДПИСКА ПОДТВЕРЖДЕНА!\n\n"
+    "Ваша ссылка готова! Нажмите на кнопку ниже, чтобы получить доступ."
+)
+
+_MSG_SUCCESS_BOT = (
+    "✅ ПОДПИСКА ПОДТВЕРЖДЕНА!\n\n"
+    "Доступ к боту предоставлен!"
+)
+
+_MSG_SUCCESS_PLAIN = (
+    "✅ ПОДПИСКА ПОДТВЕРЖДЕНА!\n\n"
+    "Спасибо за подписку!"
+)
+
+
+def _utf16_len(s: str) -> int:
+    """Длина строки в UTF-16 code units - offsets/lengths entity у Telegram именно такие."""
+    return len(s.encode('utf-16-le')) // 2
+
+
+# Жирный заголовок общий для всех трех сообщений: идет после "✅ "
+_ENT_SUCCESS = [MessageEntity(
+    type=MessageEntity.BOLD,
+    offset=_utf16_len("✅ "),
+    length=_utf16_len("ПОДПИСКА ПОДТВЕРЖДЕНА!")
+)]
+
+_MSG_ERROR = "❌ Произошла ошибка при проверке подписки. Попробуйте позже."
+
+
+def _is_not_modified(e: Exception) -> bool:
+    """
+    "Message is not modified" от Telegram при редактировании без изменений.
+
+    Проверяем короткий e.message вместо str(e).lower() - у исключений с
+    вложенными объектами полная строка может быть большой.
+    """
+    return isinstance(e, BadRequest) and "not modified" in (e.message or "").lower()
+
+
+def _edit_hash(text, markup) -> int:
+    """Хэш содержимого сообщения (текст + кнопки) для дедупликации правок."""
+    buttons = ()
+    if markup is not None:
+        buttons = tuple(
+            (b.text, b.callback_data or b.url)
+            for row in markup.inline_keyboard for b in row
+        )
+    return hash((text, buttons))
+
+
+async def _safe_edit(query, text, markup=None, parse_mode=None, entities=None, user_data=None) -> bool:
+    """
+    Редактирует сообщение, глотая "message is not modified".
+
+    Единая точка обработки ошибок редактирования - вложенные try/except
+    вокруг каждого edit_message_text больше не нужны, и упавший edit
+    не порождает повторных попыток-round-trip'ов.
+
+    Если передан user_data, запоминает хэш последней правки по message_id
+    и молча пропускает идентичную повторную правку - повторный клик по
+    "Я подписался" не платит round-trip только ради ловли "not modified".
+
+    Returns:
+        bool: True если сообщение в нужном состоянии (отредактировано или
+        уже совпадает), False при реальной ошибке.
+    """
+    h = None
+    if user_data is not None:
+        h = _edit_hash(text, markup)
+        if user_data.get('_last_edit') == (query.message.message_id, h):
+            return True
+    try:
+        await query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode, entities=entities)
+    except Exception as e:
+        if not _is_not_modified(e):
+            logger.error("Error editing message: %s", e)
+            return False
+    if h is not None:
+        user_data['_last_edit'] = (query.message.message_id, h)
+    return True
+
 
 async def check_subscription_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -27,108 +133,86 @@ async def check_subscription_callback(update: Update, context: ContextTypes.DEFA
     try:
         await query.answer("Проверяем подписку...")
     except Exception as e:
-        logger.error(f"Error answering callback query: {e}")
+        logger.error("Error answering callback query: %s", e)
 
     try:
-        async with get_session() as session:
-            # Получаем канал для проверки
-            channel_username = await get_subscription_channel()
-            
-            # Проверяем подписку
-            try:
-                is_subscribed = await check_channel_subscription(context.bot, telegram_id, channel_username)
-            except Exception as e:
-                logger.error(f"Error checking channel subscription: {e}")
-                import traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                await query.edit_message_text(
-                    "❌ Ошибка при проверке подписки. Попробуйте позже.",
-                    reply_markup=get_free_access_keyboard(channel_username)
-                )
-                return
-
-            # Если пользователь не подписан - просим подписаться
-            if not is_subscribed:
-                message = f"""
-❌ **ПОДПИСКА НЕ НАЙДЕНА**
+        # Получаем канал для проверки
+        channel_username = await get_subscription_channel()
+        
+        # Проверяем подписку (пользователь явно просит перепроверить - сбрасываем кэш)
+        invalidate_subscription_cache(telegram_id, channel_username)
+        try:
+            is_subscribed = await check_channel_subscription(context.bot, telegram_id, channel_username)
+        except Exception:
+            logger.exception("Error checking channel subscription")
+            await _safe_edit(
+                query,
+                "❌ Ошибка при проверке подписки. Попробуйте позже.",
+                markup=get_free_access_keyboard(channel_username),
+                user_data=context.user_data
+            )
+            return
 
-Пожалуйста:
-1. 📢 Подпишитесь на канал {channel_username}
-2. ✅ Нажмите "Я подписался" еще раз для проверки
-"""
-                try:
-                    await query.edit_message_text(message, reply_markup=get_free_access_keyboard(channel_username))
-                except Exception as edit_error:
-                    if "not modified" not in str(edit_error).lower():
-                        logger.error(f"Error editing message: {edit_error}")
-                return
-
-            # Пользователь подписан - проверяем, пришел ли через кнопку канала
-            channel_button_link = context.user_data.get('channel_button_link')
-            channel_button_type = context.user_data.get('channel_button_type')
-            
-            if channel_button_link:
-                # Пользователь пришел через кнопку канала - выдаем ссылку
-                if channel_button_type == "external":
-                    # Внешняя ссылка - показываем кнопку со ссылкой
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔗 Получить доступ", url=channel_button_link)]
-                    ])
-                    success_message = """
-✅ **ПОДПИСКА ПОДТВЕРЖДЕНА!**
-
-Ваша ссылка готова! Нажмите на кнопку ниже, чтобы получить доступ.
-"""
-                else:
-                    # Доступ к боту - просто подтверждаем
-                    keyboard = InlineKeyboardMarkup([])
-                    success_message = """
-✅ **ПОДПИСКА ПОДТВЕРЖДЕНА!**
+        # Если пользователь не подписан - просим подписаться
+        if not is_subscribed:
+            await _safe_edit(
+                query,
+                _MSG_NOT_SUBSCRIBED.format(channel=channel_username),
+                markup=get_free_access_keyboard(channel_username),
+                user_data=context.user_data
+            )
+            return
 
-Доступ к боту предоставлен!
-"""
-                
-                try:
-                    await query.edit_message_text(
-                        success_message,
-                        reply_markup=keyboard,
-                        parse_mode="Markdown"
-                    )
-                    # Очищаем данные о кнопке после выдачи ссылки
-                    context.user_data.pop('channel_button_link', None)
-                    context.user_data.pop('channel_button_type', None)
-                    context.user_data.pop('channel_button_id', None)
-                    logger.info(f"✅ Link issued to user {telegram_id}: {channel_button_link}, type: {channel_button_type}")
-                except Exception as e:
-                    logger.error(f"Error sending success message: {e}")
+        # Пользователь подписан - проверяем, пришел ли через кнопку канала
+        channel_button = context.user_data.get('channel_button') or {}
+        channel_button_link = channel_button.get('link')
+        channel_button_type = channel_button.get('type')
+
+        if channel_button_link:
+            # Пользователь пришел через кнопку канала - выдаем ссылку
+            if channel_button_type == "external":
+                # Внешняя ссылка - показываем кнопку со ссылкой
+                keyboard = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔗 Получить доступ", url=channel_button_link)]
+                ])
+                success_message = _MSG_SUCCESS_EXTERNAL
             else:
-                # Обычная проверка подписки (не через кнопку канала)
-                await query.edit_message_text(
-                    "✅ **ПОДПИСКА ПОДТВЕРЖДЕНА!**\n\n"
-                    "Спасибо за подписку!",
-                    parse_mode="Markdown"
-                )
+                # Доступ к боту - просто подтверждаем
+                keyboard = _EMPTY_KB
+                success_message = _MSG_SUCCESS_BOT
+            
+            if await _safe_edit(query, success_message, markup=keyboard, entities=_ENT_SUCCESS,
+                                user_data=context.user_data):
+                # Очищаем данные о кнопке после выдачи ссылки (один pop -
+                # состояние не остается наполовину очищенным)
+                context.user_data.pop('channel_button', None)
+                logger.info("✅ Link issued to user %s: %s, type: %s", telegram_id, channel_button_link, channel_button_type)
+        else:
+            # Обычная проверка подписки (не через кнопку канала)
+            await _safe_edit(query, _MSG_SUCCESS_PLAIN, entities=_ENT_SUCCESS,
+                             user_data=context.user_data)
 
-    except Exception as e:
-        logger.error(f"Unexpected error in check_subscription_callback: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Unexpected error in check_subscription_callback")
         # Получаем канал для fallback
         try:
             channel_username = await get_subscription_channel()
-            await query.edit_message_text(
-                "❌ Произошла ошибка при проверке подписки. Попробуйте позже.",
-                reply_markup=get_free_access_keyboard(channel_username)
-            )
         except Exception as e2:
-            if "not modified" not in str(e2).lower():
-                logger.error(f"Error sending error message: {e2}")
+            logger.error("Error getting fallback channel: %s", e2)
+            channel_username = None
+        await _safe_edit(
+            query,
+            _MSG_ERROR,
+            markup=get_free_access_keyboard(channel_username) if channel_username else None,
+            user_data=context.user_data
+        )
 
 
 def register_subscription_handlers(application):
     """Register subscription handlers."""
     application.add_handler(CallbackQueryHandler(
         check_subscription_callback,
-        pattern="^payment:check_subscription$"
+        pattern=_CHECK_SUBSCRIPTION_PATTERN,
+        block=False
     ))
     logger.info("✅ Subscription handlers registered")
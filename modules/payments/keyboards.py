@@ -2,10 +2,28 @@
 Keyboards for Lead Magnet Bot.
 """
 
+from functools import lru_cache
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from config import Config
+
+# channel_username -> готовый https://t.me/... URL; lstrip и f-string
+# выполняются один раз на канал, а не на каждый показ клавиатуры
+_URL_CACHE: dict = {}
+
+
+def _url_for(channel_username: str) -> str:
+    """Возвращает URL канала, лениво кэшируя его по username."""
+    url = _URL_CACHE.get(channel_username)
+    if url is None:
+        url = f"https://t.me/{channel_username.lstrip('@')}"
+        _URL_CACHE[channel_username] = url
+    return url
 
-def get_free_access_keyboard(channel_username: str) -> InlineKeyboardMarkup:
+
+@lru_cache(maxsize=128)
+def get_free_access_keyboard(channel_username: str = Config.CHANNEL_USERNAME) -> InlineKeyboardMarkup:
     """
     Клавиатура для проверки подписки на канал.
     
@@ -14,11 +32,13 @@ def get_free_access_keyboard(channel_username: str) -> InlineKeyboardMarkup:
     
     Returns:
         InlineKeyboardMarkup: Клавиатура с кнопками
+
+    Разметка зависит только от username канала и никем не мутируется -
+    lru_cache убирает аллокацию кнопок на каждый показ диалога подписки.
     """
-    # Убираем @ если есть для URL
-    channel_for_url = channel_username.lstrip('@')
-    channel_url = f"https://t.me/{channel_for_url}"
-    
+    # Убираем @ если есть для URL (кэшируется по каналу)
+    channel_url = _url_for(channel_username)
+
     keyboard = [
         [
             InlineKeyboardButton("📢 Подписаться на канал", url=channel_url),
@@ -28,12 +48,15 @@ def get_free_access_keyboard(channel_username: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+# Админ-панель полностью статична - собираем разметку один раз при импорте
+_ADMIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Создать пост с кнопкой", callback_data="admin:add_button")],
+    [InlineKeyboardButton("📊 Статистика по кнопкам", callback_data="admin:button_stats")],
+    [InlineKeyboardButton("⚙️ Настройки канала", callback_data="admin:channel_settings")],
+    [InlineKeyboardButton("📝 Список команд", callback_data="admin:commands")]
+])
+
+
 def get_admin_panel_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура админ-панели."""
-    keyboard = [
-        [InlineKeyboardButton("➕ Создать пост с кнопкой", callback_data="admin:add_button")],
-        [InlineKeyboardButton("📊 Статистика по кнопкам", callback_data="admin:button_stats")],
-        [InlineKeyboardButton("⚙️ Настройки канала", callback_data="admin:channel_settings")],
-        [InlineKeyboardButton("📝 Список команд", callback_data="admin:commands")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _ADMIN_KB
@@ -3,9 +3,12 @@ Subscription logic for Lead Magnet Bot.
 Handles channel subscription checks.
 """
 
+import asyncio
 import logging
+import time
 from typing import Optional
-from sqlalchemy import select
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from telegram.error import BadRequest
 from telegram.constants import ChatMemberStatus
@@ -16,6 +19,83 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
+# TTL кэша результатов проверки подписки (секунды)
+SUBSCRIPTION_CACHE_TTL = 60
+
+# Негативный TTL для ошибок BadRequest (канал недоступен / бот не админ):
+# короткий, чтобы не долбить Telegram, но быстро восстановиться после фикса прав
+SUBSCRIPTION_ERROR_CACHE_TTL = 5
+
+# (telegram_id, channel_username) -> (expires_at, is_subscribed)
+_sub_cache: dict = {}
+
+# Статусы, считающиеся подпиской: O(1) membership без аллокации списка
+# на каждую проверку. В PTB 20.x владелец канала - OWNER (бывший CREATOR)
+_SUBSCRIBED_STATUSES = frozenset({
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.OWNER,
+})
+
+# Single-flight: ключ -> Future текущей проверки. Двойной клик
+# "Я подписался" ждет уже запущенный get_chat_member, а не шлет второй
+_inflight: dict = {}
+
+# Event-driven множество подписчиков канала: пополняется push-апдейтами
+# chat_member, так что типовая проверка - чистый set lookup без сети.
+# Positive-only: промах означает "не знаем", а не "не подписан" -
+# тогда идем обычным путем через кэш/get_chat_member
+_subscribers: set = set()
+
+
+async def on_chat_member_update(update, context) -> None:
+    """
+    Обработчик chat_member-апдейтов канала подписки.
+
+    Держит _subscribers актуальным в реальном времени: вступил - добавили,
+    вышел/забанен - убрали. Требует, чтобы бот был администратором канала
+    (иначе Telegram не шлет такие апдейты) и allowed_updates включал
+    chat_member - run_polling уже запрашивает Update.ALL_TYPES.
+    """
+    cmu = update.chat_member
+    if cmu is None:
+        return
+
+    # Интересуют только события нашего канала подписки
+    chat_username = f"@{cmu.chat.username}" if cmu.chat.username else None
+    channel = await get_subscription_channel()
+    if chat_username != channel:
+        return
+
+    user_id = cmu.new_chat_member.user.id
+    cache_key = (user_id, channel)
+    if cmu.new_chat_member.status in _SUBSCRIBED_STATUSES:
+        _subscribers.add(user_id)
+        _sub_cache[cache_key] = (time.monotonic() + SUBSCRIPTION_CACHE_TTL, True)
+        logger.info("Subscriber joined %s: %s", channel, user_id)
+    else:
+        _subscribers.discard(user_id)
+        _sub_cache.pop(cache_key, None)
+        logger.info("Subscriber left %s: %s", channel, user_id)
+
+
+def invalidate_subscription_cache(telegram_id: int, channel_username: Optional[str] = None) -> None:
+    """
+    Сбрасывает кэшированный результат проверки подписки для пользователя.
+
+    Вызывается из кнопки "✅ Я подписался", чтобы пользователь мог
+    перепроверить подписку, не дожидаясь истечения TTL. Сбрасывает и запись
+    в _subscribers: если апдейт о выходе из канала потерялся, fast path
+    отвечал бы True вечно - явная перепроверка должна дойти до Telegram,
+    а апдейты/свежий get_chat_member наберут множество заново.
+    """
+    _subscribers.discard(telegram_id)
+    if channel_username is not None:
+        _sub_cache.pop((telegram_id, channel_username), None)
+    else:
+        for key in [k for k in _sub_cache if k[0] == telegram_id]:
+            _sub_cache.pop(key, None)
+
 
 async def get_or_create_user(
     telegram_id: int,
@@ -23,7 +103,32 @@ async def get_or_create_user(
     username: Optional[str] = None,
     first_name: Optional[str] = None
 ) -> User:
-    """Get existing user or create new one."""
+    """
+    Get existing user or create new one.
+
+    На Postgres - один атомарный INSERT ... ON CONFLICT DO UPDATE RETURNING
+    (без гонок при конкурентных /start). На SQLite (DEV_MODE) - обычный
+    SELECT-then-INSERT.
+    """
+    if session.bind.dialect.name == "postgresql":
+        stmt = pg_insert(User).values(
+            telegram_id=telegram_id,
+            username=username,
+            first_name=first_name
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={
+                'username': stmt.excluded.username,
+                'first_name': stmt.excluded.first_name,
+                'last_activity': func.now(),
+            }
+        ).returning(User)
+        result = await session.execute(stmt)
+        user = result.scalar_one()
+        await session.commit()
+        return user
+
     result = await session.execute(
         select(User).where(User.telegram_id == telegram_id)
     )
@@ -38,33 +143,59 @@ async def get_or_create_user(
         session.add(user)
         await session.commit()
         await session.refresh(user)
-        logger.info(f"Created new user: {telegram_id}")
+        logger.info("Created new user: %s", telegram_id)
 
     return user
 
 
+# TTL кэша настройки канала (секунды); настройка меняется редко,
+# а читается на каждой проверке подписки и рендере админ-панели
+_CHANNEL_CACHE_TTL = 300
+
+# (expires_at, channel_username) или None
+_channel_cache: Optional[tuple] = None
+
+
+def invalidate_subscription_channel() -> None:
+    """Сбрасывает кэш канала подписки (вызывается при смене настройки админом)."""
+    global _channel_cache
+    _channel_cache = None
+    # Подписчики относились к старому каналу - набираем заново из апдейтов
+    _subscribers.clear()
+
+
 async def get_subscription_channel() -> str:
     """
     Получает канал для проверки подписки из БД или конфига.
-    
+
+    Результат кэшируется в памяти на _CHANNEL_CACHE_TTL секунд;
+    админская смена канала сбрасывает кэш сразу.
+
     Returns:
         str: Username канала (например: @channel_username)
     """
+    global _channel_cache
+    if _channel_cache and _channel_cache[0] > time.monotonic():
+        return _channel_cache[1]
+
     try:
         async with get_session() as session:
             result = await session.execute(
                 select(BotSettings).where(BotSettings.key == "subscription_channel")
             )
             setting = result.scalar_one_or_none()
-            
+
             if setting and setting.value:
-                return setting.value
-            
-            # Fallback на конфиг
-            return Config.CHANNEL_USERNAME
+                value = setting.value
+            else:
+                # Fallback на конфиг
+                value = Config.CHANNEL_USERNAME
+
+            _channel_cache = (time.monotonic() + _CHANNEL_CACHE_TTL, value)
+            return value
     except Exception as e:
-        logger.error(f"Error getting subscription channel from DB: {e}")
-        # Fallback на конфиг
+        logger.error("Error getting subscription channel from DB: %s", e)
+        # Fallback на конфиг (не кэшируем, чтобы восстановиться после сбоя БД)
         return Config.CHANNEL_USERNAME
 
 
@@ -72,6 +203,10 @@ async def check_channel_subscription(bot, telegram_id: int, channel_username: Op
     """
     Проверяет, подписан ли пользователь на канал.
 
+    Результат кэшируется в памяти на SUBSCRIPTION_CACHE_TTL секунд -
+    повторные клики "Я подписался" и /start не ходят в Telegram API.
+    Ошибки BadRequest кэшируются на короткий SUBSCRIPTION_ERROR_CACHE_TTL.
+
     Args:
         bot: Экземпляр Telegram бота
         telegram_id: Telegram ID пользователя
@@ -83,7 +218,37 @@ async def check_channel_subscription(bot, telegram_id: int, channel_username: Op
     # Получаем канал для проверки
     if not channel_username:
         channel_username = await get_subscription_channel()
-    
+
+    # Event-driven fast path: подписка подтверждена push-апдейтом chat_member
+    if telegram_id in _subscribers:
+        return True
+
+    cache_key = (telegram_id, channel_username)
+    entry = _sub_cache.get(cache_key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    # Request coalescing: если проверка этого же пользователя уже в полете,
+    # присоединяемся к ней вместо второго запроса к Telegram
+    fut = _inflight.get(cache_key)
+    if fut is not None:
+        return await fut
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = fut
+    try:
+        is_subscribed = await _fetch_subscription_status(bot, telegram_id, channel_username, cache_key)
+        fut.set_result(is_subscribed)
+        return is_subscribed
+    finally:
+        _inflight.pop(cache_key, None)
+        if not fut.done():
+            # Нас отменили до получения результата - будим присоединившихся
+            fut.cancel()
+
+
+async def _fetch_subscription_status(bot, telegram_id: int, channel_username: str, cache_key: tuple) -> bool:
+    """Реальный поход в Telegram API за статусом подписки (без кэша и дедупликации)."""
     try:
         # Используем getChatMember для проверки статуса пользователя в канале
         member = await bot.get_chat_member(
@@ -93,27 +258,24 @@ async def check_channel_subscription(bot, telegram_id: int, channel_username: Op
 
         # Проверяем статус участника
         status = member.status
-        
-        # Пользователь подписан если статус MEMBER, ADMINISTRATOR или CREATOR
-        is_subscribed = status in [
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.CREATOR
-        ]
-        
-        logger.info(f"User {telegram_id} subscription status: {status} -> {is_subscribed}")
+
+        # Пользователь подписан если статус MEMBER, ADMINISTRATOR или OWNER
+        is_subscribed = status in _SUBSCRIBED_STATUSES
+
+        logger.info("User %s subscription status: %s -> %s", telegram_id, status, is_subscribed)
+        _sub_cache[cache_key] = (time.monotonic() + SUBSCRIPTION_CACHE_TTL, is_subscribed)
         return is_subscribed
-        
+
     except BadRequest as e:
-        # Если канал недоступен или бот не является администратором
-        error_message = str(e).lower()
-        if "member list is inaccessible" in error_message:
-            logger.warning(f"Channel member list is inaccessible for user {telegram_id}. Bot may not be admin.")
+        # Если канал недоступен или бот не является администратором.
+        # Кэшируем False с коротким TTL, чтобы ретраи не били по API
+        _sub_cache[cache_key] = (time.monotonic() + SUBSCRIPTION_ERROR_CACHE_TTL, False)
+        # e.message - короткий текст ошибки API, без repr вложенных объектов
+        if "member list is inaccessible" in (e.message or "").lower():
+            logger.warning("Channel member list is inaccessible for user %s. Bot may not be admin.", telegram_id)
             return False
-        logger.error(f"BadRequest checking subscription: {e}")
+        logger.error("BadRequest checking subscription: %s", e)
         return False
-    except Exception as e:
-        logger.error(f"Error checking channel subscription: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error checking channel subscription")
         return False
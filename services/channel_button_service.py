@@ -5,13 +5,18 @@ Channel Button Service - управление кнопками в постах 
 Генерирует ссылки на бота с отслеживанием нажатий.
 """
 
+import asyncio
 import logging
-from typing import Optional
+from typing import List, Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import TelegramError
 
 logger = logging.getLogger(__name__)
 
+# Максимум одновременных отправок при массовой публикации: держимся
+# ниже бот-лимита Telegram (~30 сообщений в секунду)
+_MAX_CONCURRENT_PUBLISHES = 25
+
 
 class ChannelButtonService:
     """Сервис для работы с кнопками в постах канала."""
@@ -111,8 +116,33 @@ class ChannelButtonService:
         except TelegramError as e:
             logger.error(f"Telegram error publishing post: {e}")
             return None
-        except Exception as e:
-            logger.error(f"Error publishing post: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+        except Exception:
+            logger.exception("Error publishing post")
             return None
+
+    @staticmethod
+    async def publish_many(bot, items: List[dict]) -> List[Optional[int]]:
+        """
+        Публикует несколько постов с кнопками параллельно.
+
+        Вместо последовательного цикла с полным HTTPS round-trip на пост
+        отправляет все посты одним gather'ом; семафор удерживает
+        конкурентность ниже бот-лимита Telegram.
+
+        Args:
+            bot: Экземпляр Telegram бота
+            items: Список kwargs для publish_post_with_button (без bot)
+
+        Returns:
+            Список message_id в порядке items (None для неудавшихся постов)
+        """
+        sem = asyncio.Semaphore(_MAX_CONCURRENT_PUBLISHES)
+
+        async def _one(item: dict) -> Optional[int]:
+            async with sem:
+                return await ChannelButtonService.publish_post_with_button(bot=bot, **item)
+
+        results = await asyncio.gather(*(_one(item) for item in items), return_exceptions=True)
+        # publish_post_with_button сам переводит ошибки в None; сюда может
+        # долететь разве что CancelledError-подобное - тоже считаем неуспехом
+        return [None if isinstance(r, BaseException) else r for r in results]